@@ -18,17 +18,21 @@ import sys
 
 
 import bz2
+import collections
+import functools
+import concurrent.futures
+import copy
 import datetime
 import gzip
 import http.client
-import inspect
-import itertools
+import io
 import logging
+import mmap
 import os
 import os.path
-import queue
 import re
 import sys
+import struct
 import threading
 import time
 import urllib.request, urllib.parse, urllib.error
@@ -49,6 +53,89 @@ except ImportError:
         print('simplejson (http://pypi.python.org/pypi/simplejson/) is required.', file=sys.stderr)
         sys.exit(1)
 
+# orjson (https://pypi.org/project/orjson/) is optional. When available, JSON
+# bodies and responses are encoded/decoded by its native implementation, which
+# produces utf-8 bytes directly instead of going str -> encode.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+if orjson is not None:
+    def _json_dumps(obj):
+        return orjson.dumps(obj)
+
+    def _json_loads(data):
+        return orjson.loads(data)
+else:
+    def _json_dumps(obj):
+        return json.dumps(obj).encode('utf-8')
+
+    def _json_loads(data):
+        if isinstance(data, (bytes, bytearray)):
+            data = data.decode('utf-8')
+        return json.loads(data)
+
+# Hyperscan (https://pypi.org/project/hyperscan/) is optional. When available,
+# the regex based formats use it as a fast pre-filter that rejects
+# non-matching lines before the (much slower) backtracking re engine runs.
+try:
+    import hyperscan
+except ImportError:
+    hyperscan = None
+
+# ciso8601 (https://pypi.org/project/ciso8601/) is optional. When available,
+# formats with ISO 8601 dates parse them in C instead of going through
+# datetime.strptime.
+try:
+    import ciso8601
+except ImportError:
+    ciso8601 = None
+
+# google-re2 (https://pypi.org/project/google-re2/) is optional. When
+# available, the format regexes run on RE2, which guarantees linear-time
+# matching instead of re's backtracking worst case.
+try:
+    import re2
+except ImportError:
+    re2 = None
+
+def _compile_regex(pattern, flags=0):
+    '''
+    Compile with RE2 when available and the pattern is supported by it,
+    falling back to the stdlib re engine otherwise.
+    '''
+    if re2 is not None:
+        try:
+            return re2.compile(pattern, flags)
+        except Exception:
+            logging.debug("Pattern not supported by re2, using re: %s", pattern)
+    return re.compile(pattern, flags)
+
+# pyahocorasick (https://pypi.org/project/pyahocorasick/) is optional. When
+# available, the tracking path patterns are prefiltered through one literal
+# automaton pass instead of trying every regex on every hit.
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+# urllib3 (https://pypi.org/project/urllib3/) is optional. When available,
+# requests to Matomo go through a shared keep-alive connection pool instead of
+# opening a fresh TCP/TLS connection per call.
+try:
+    import urllib3
+except ImportError:
+    urllib3 = None
+
+# Transient failures that Matomo._call_wrapper retries. urllib3 raises its own
+# exception hierarchy rather than urllib's, so pull in its base class when the
+# pooled backend is in use.
+_RETRYABLE_ERRORS = (urllib.error.URLError, http.client.HTTPException,
+                     ValueError, socket.timeout)
+if urllib3 is not None:
+    _RETRYABLE_ERRORS += (urllib3.exceptions.HTTPError,)
+
 
 
 ##
@@ -59,11 +146,16 @@ MATOMO_DEFAULT_MAX_ATTEMPTS = 3
 MATOMO_DEFAULT_DELAY_AFTER_FAILURE = 10
 DEFAULT_SOCKET_TIMEOUT = 300
 
+MONTHS = {'Jan': 1, 'Feb': 2, 'Mar': 3, 'Apr': 4,
+          'May': 5, 'Jun': 6, 'Jul': 7, 'Aug': 8,
+          'Sep': 9, 'Oct': 10, 'Nov': 11, 'Dec': 12}
+
 ARGS = ArgumentParser()
 ARGS.add_argument("--debug", action="store_true", help="Enable debugging")
 ARGS.add_argument("--server", help="Overwrite the destination matomo server")
 ARGS.add_argument("--dry-run", action="store_true", help="Enable dry run, i.e. don't send data to server")
 ARGS.add_argument("-s", "--skip", type=int, default=0, help="Skip the given amount of lines in the logs (useful to continue processing)")
+ARGS.add_argument("-j", "--jobs", type=int, default=1, help="Number of log files to parse concurrently")
 ARGS.add_argument("logs", help="Directory containing the log-files")
 ##
 ## Formats.
@@ -73,6 +165,7 @@ class BaseFormatException(Exception): pass
 
 class BaseFormat(object):
     BASE_DATE_FORMAT = '%d/%b/%Y:%H:%M:%S'
+    ISO_DATE_FORMAT = '%Y-%m-%dT%H:%M:%S'
     def __init__(self, name):
         self.name = name
         self.regex = None
@@ -88,23 +181,47 @@ class BaseFormat(object):
 
         return self.check_format_line(line)
 
+    def may_emit_quotes(self, field):
+        '''
+        Whether the named field can come out wrapped in its delimiting
+        quotes. Formats that know better override this so the per-line
+        dequoting checks can be dropped entirely.
+        '''
+        return True
+
     '''
     This is a shorthand parser if the date is given in the default BASE_DATE_FORMAT
     
     When processing large chunks this actually results in a huge performance improvement
     '''
-    def _parseTimeFast(self, date_string):
-        year = int(date_string[7:11])
-        month = MONTHS[date_string[3:6]]
-        day = int(date_string[0:2])
-        hour = int(date_string[12:14])
-        minute = int(date_string[15:17])
-        second = int(date_string[18:20])
-        return datetime.datetime(year, month, day, hour, minute, second)        
+    def _parseTimeFast(self, date_string, _int=int, _month=MONTHS.__getitem__, _datetime=datetime.datetime):
+        # the lookups this needs are pre-bound as default arguments: this runs
+        # once per log line and LOAD_GLOBAL/dict dispatch add up there
+        year = _int(date_string[7:11])
+        month = _month(date_string[3:6])
+        day = _int(date_string[0:2])
+        hour = _int(date_string[12:14])
+        minute = _int(date_string[15:17])
+        second = _int(date_string[18:20])
+        return _datetime(year, month, day, hour, minute, second)
 
     def _parseTimeSlow(self, date_string):
         return datetime.datetime.strptime(date_string, self.date_format)
 
+    def _parseTimeIso(self, date_string):
+        return ciso8601.parse_datetime_as_naive(date_string)
+
+    def _bind_time_parser(self):
+        '''
+        Pick the fastest available parser for self.date_format.
+        '''
+        if self.date_format == BaseFormat.BASE_DATE_FORMAT:
+            self.parseTime = MethodType(BaseFormat._parseTimeFast, self)
+        elif self.date_format == BaseFormat.ISO_DATE_FORMAT and ciso8601 is not None:
+            self.parseTime = MethodType(BaseFormat._parseTimeIso, self)
+        else:
+            self.parseTime = MethodType(BaseFormat._parseTimeSlow, self)
+
     def check_format_line(self, line):
         return False
 
@@ -112,12 +229,12 @@ class JsonFormat(BaseFormat):
     def __init__(self, name):
         super(JsonFormat, self).__init__(name)
         self.json = None
-        self.date_format = '%Y-%m-%dT%H:%M:%S'
-        self.parseTime = MethodType(BaseFormat._parseTimeSlow, self)
+        self.date_format = BaseFormat.ISO_DATE_FORMAT
+        self._bind_time_parser()
 
     def check_format_line(self, line):
         try:
-            self.json = json.loads(line)
+            self.json = _json_loads(line)
             return True
         except:
             return False
@@ -129,7 +246,7 @@ class JsonFormat(BaseFormat):
             # so it does not take into account the string's actual encoding (which we don't have access to).
             line = line.replace('\\x', '\\u00')
 
-            self.json = json.loads(line)
+            self.json = _json_loads(line)
             return self
         except:
             self.json = None
@@ -159,41 +276,98 @@ class JsonFormat(BaseFormat):
 
 class RegexFormat(BaseFormat):
 
+    # named groups are not supported by hyperscan, strip them for the pre-filter
+    HYPERSCAN_NAMED_GROUP = re.compile(r'\(\?P<[^>]+>')
+
     def __init__(self, name, regex, date_format=None):
         super(RegexFormat, self).__init__(name)
+        self.hyperscan_db = None
         if regex is not None:
-            self.regex = re.compile(regex)
+            self.regex = _compile_regex(regex)
+            if hyperscan is not None:
+                self.hyperscan_db = self._compile_hyperscan(regex)
         if date_format is not None:
             self.date_format = date_format
-            if self.date_format != BaseFormat.BASE_DATE_FORMAT:
-                self.parseTime = MethodType(BaseFormat._parseTimeSlow, self)
+            self._bind_time_parser()
         self.matched = None
 
+    def _compile_hyperscan(self, regex):
+        '''
+        Compile the format regex into a hyperscan block-mode database.
+
+        Hyperscan compiles to a DFA without backtracking, but it cannot report
+        named groups, so it is used only to reject lines: a line with no
+        hyperscan match can never match the re pattern either, while matching
+        lines still go through re for the group extraction.
+        '''
+        expression = RegexFormat.HYPERSCAN_NAMED_GROUP.sub('(?:', regex)
+        try:
+            db = hyperscan.Database()
+            db.compile(expressions=[expression.encode('utf-8')],
+                       flags=[hyperscan.HS_FLAG_SOM_LEFTMOST])
+            return db
+        except Exception:
+            # not all re constructs are supported by hyperscan
+            logging.debug("Cannot compile format %s for hyperscan, using re only", self.name)
+            return None
+
+    def _prefilter(self, line):
+        matches = []
+        def on_match(id, from_, to, flags, context):
+            matches.append((from_, to))
+        self.hyperscan_db.scan(line.encode('utf-8', 'replace'), match_event_handler=on_match)
+        return bool(matches)
+
     def check_format_line(self, line):
         return self.match(line)
 
     def match(self,line):
         if not self.regex:
             return None
-        match_result = self.regex.match(line)
-        if match_result:
-            self.matched = match_result.groupdict()
-        else:
+        if self.hyperscan_db is not None and not self._prefilter(line):
             self.matched = None
-        return match_result
+            return None
+        # the match object is kept as-is: group lookup on it is a C level
+        # operation, while groupdict() would build a fresh dict per line
+        self.matched = self.regex.match(line)
+        return self.matched
+
+    def may_emit_quotes(self, field):
+        # a group preceded by a literal quote in the pattern is
+        # quote-delimited, so its captured text can never start with one;
+        # a missing group never reaches the dequoting check at all
+        pattern = self.regex.pattern if self.regex else ''
+        idx = pattern.find('(?P<%s>' % field)
+        if idx == -1:
+            return False
+        return pattern[idx - 1:idx] != '"'
 
     def get(self, key):
         try:
             return self.matched[key]
-        except KeyError:
+        except (KeyError, IndexError):
             raise BaseFormatException("Cannot find group '%s'." % key)
 
     def get_all(self,):
-        return self.matched
+        if self.matched is None or isinstance(self.matched, dict):
+            return self.matched
+        return self.matched.groupdict()
 
     def remove_ignored_groups(self, groups):
+        matched = self.get_all()
         for group in groups:
-            del self.matched[group]
+            del matched[group]
+        self.matched = matched
+
+def _fast_unquote(value):
+    '''
+    urllib.parse.unquote runs a pure Python regex replacement loop; almost no
+    user agents actually contain percent escapes, so skip it unless one does
+    and use the C implemented unquote_to_bytes when it is needed.
+    '''
+    if '%' not in value:
+        return value
+    return urllib.parse.unquote_to_bytes(value).decode('utf-8', 'replace')
 
 class W3cExtendedFormat(RegexFormat):
 
@@ -205,7 +379,7 @@ class W3cExtendedFormat(RegexFormat):
         'cs-uri-stem': '(?P<path>/\S*)',
         'cs-uri-query': '(?P<query_string>\S*)',
         'c-ip': '"?(?P<ip>[\w*.:-]*)"?',
-        'cs(User-Agent)': '(?P<user_agent>".*?"|\S*)',
+        'cs(User-Agent)': '(?P<user_agent>"[^"]*"|\S*)',
         'cs(Referer)': '(?P<referrer>\S+)',
         'sc-status': '(?P<status>\d+)',
         'sc-bytes': '(?P<length>\S+)',
@@ -284,13 +458,17 @@ class W3cExtendedFormat(RegexFormat):
             try:
                 regex = expected_fields[field]
             except KeyError:
-                regex = '(?:".*?"|\S+)'
+                regex = '(?:"[^"]*"|\S+)'
             full_regex.append(regex)
-        full_regex = '\s+'.join(full_regex)
+        # anchor the pattern and join fields on the literal whitespace classes
+        # found in these logs; generic \s+ joins make the NFA explore far more
+        # states on malformed lines. re.ASCII additionally keeps \w/\S/\d away
+        # from the Unicode property tables.
+        full_regex = '\A' + '[ \t]+'.join(full_regex)
 
         logging.debug("Based on 'Fields:' line, computed regex to be %s", full_regex)
 
-        self.regex = re.compile(full_regex)
+        self.regex = _compile_regex(full_regex, re.ASCII)
 
     def check_for_iis_option(self):
        logging.info("WARNING: IIS log file being parsed without --w3c-time-taken-milli option. IIS"
@@ -335,7 +513,7 @@ class ShoutcastFormat(W3cExtendedFormat):
     def get(self, key):
         if key == 'user_agent':
             user_agent = super(ShoutcastFormat, self).get(key)
-            return urllib.parse.unquote(user_agent)
+            return _fast_unquote(user_agent)
         else:
             return super(ShoutcastFormat, self).get(key)
 
@@ -346,13 +524,13 @@ class AmazonCloudFrontFormat(W3cExtendedFormat):
         'x-event': '(?P<event_action>\S+)',
         'x-sname': '(?P<event_name>\S+)',
         'cs-uri-stem': '(?:rtmp:/)?(?P<path>/\S*)',
-        'c-user-agent': '(?P<user_agent>".*?"|\S+)',
+        'c-user-agent': '(?P<user_agent>"[^"]*"|\S+)',
 
         # following are present to match cloudfront instead of W3C when we know it's cloudfront
-        'x-edge-location': '(?P<x_edge_location>".*?"|\S+)',
-        'x-edge-result-type': '(?P<x_edge_result_type>".*?"|\S+)',
-        'x-edge-request-id': '(?P<x_edge_request_id>".*?"|\S+)',
-        'x-host-header': '(?P<x_host_header>".*?"|\S+)'
+        'x-edge-location': '(?P<x_edge_location>"[^"]*"|\S+)',
+        'x-edge-result-type': '(?P<x_edge_result_type>"[^"]*"|\S+)',
+        'x-edge-request-id': '(?P<x_edge_request_id>"[^"]*"|\S+)',
+        'x-host-header': '(?P<x_host_header>"[^"]*"|\S+)'
     })
 
     def __init__(self):
@@ -361,16 +539,166 @@ class AmazonCloudFrontFormat(W3cExtendedFormat):
         self.name = 'amazon_cloudfront'
 
     def get(self, key):
-        if key == 'event_category' and 'event_category' not in self.matched:
+        if key == 'event_category' and 'event_category' not in self.regex.groupindex:
             return 'cloudfront_rtmp'
-        elif key == 'status' and 'status' not in self.matched:
+        elif key == 'status' and 'status' not in self.regex.groupindex:
             return '200'
         elif key == 'user_agent':
             user_agent = super(AmazonCloudFrontFormat, self).get(key)
-            return urllib.parse.unquote(user_agent)
+            return _fast_unquote(user_agent)
         else:
             return super(AmazonCloudFrontFormat, self).get(key)
 
+class FastApacheFormat(BaseFormat):
+    '''
+    Hand-written scanner for the common/NCSA style Apache formats. Their field
+    layout is fixed (space separated tokens, one bracketed date and up to
+    three quoted regions), so a single linear pass with str.index replaces the
+    regex engine on the hot path. Lines the scanner cannot make sense of are
+    delegated to the wrapped RegexFormat, so the accepted input is unchanged.
+    '''
+
+    # formats this scanner understands: name -> (host prefix?, referrer/ua?)
+    LAYOUTS = {
+        'common': (False, False),
+        'common_vhost': (True, False),
+        'ncsa_extended': (False, True),
+        'common_complete': (True, True),
+    }
+
+    # the wrapped regexes restrict these tokens to character classes the
+    # space-delimited scan does not enforce; anything looser (e.g. an
+    # X-Forwarded-For style "1.2.3.4," ip) must keep falling through to the
+    # regex so it is rejected the same way as before
+    IP_TOKEN = re.compile(r'[\w*.:-]+\Z')
+    HOST_TOKEN = re.compile(r'[\w\-.]*\Z')
+
+    def __init__(self, regex_format):
+        super(FastApacheFormat, self).__init__(regex_format.name)
+        self.fallback = regex_format
+        self.has_host, self.has_referrer = FastApacheFormat.LAYOUTS[regex_format.name]
+        self.matched = None
+
+    def check_format_line(self, line):
+        return self.match(line)
+
+    def may_emit_quotes(self, field):
+        # the scanner slices between the quotes; unusual lines fall back to
+        # the regex, whose relevant groups are quote-delimited as well
+        return self.fallback.may_emit_quotes(field)
+
+    def match(self, line):
+        try:
+            matched = self._scan(line)
+        except (ValueError, IndexError):
+            matched = None
+        if matched is None:
+            # unusual lines go through the regex engine instead
+            result = self.fallback.match(line)
+            self.matched = self.fallback.matched if result else None
+            return result
+        self.matched = matched
+        return matched
+
+    def _scan(self, line):
+        pos = 0
+        if self.has_host:
+            sp = line.index(' ')
+            host = line[:sp]
+            # the regex keeps an optional :port out of the host group
+            colon = host.rfind(':')
+            if colon != -1 and host[colon + 1:].isdecimal():
+                host = host[:colon]
+            if FastApacheFormat.HOST_TOKEN.fullmatch(host) is None:
+                return None
+            pos = sp + 1
+        sp = line.index(' ', pos)
+        ip = line[pos:sp]
+        if FastApacheFormat.IP_TOKEN.fullmatch(ip) is None:
+            return None
+        lb = line.index('[', sp)
+        rb = line.index(']', lb)
+        # the regex demands whitespace right before the date bracket; without
+        # this a '[' inside the userid token would silently shift all fields
+        if not line[lb - 1].isspace():
+            return None
+        head = line[sp:lb].split()
+        if len(head) != 2:
+            return None
+        userid = head[1]
+        date_part = line[lb + 1:rb]
+        # exactly two tokens joined by one single space; anything fancier
+        # (leading whitespace, tabs, several runs) goes through the regex,
+        # which splits such brackets differently
+        date_tokens = date_part.split(' ')
+        if len(date_tokens) != 2 or date_part.split() != date_tokens:
+            return None
+        q1 = line.index('"', rb)
+        if not line[rb + 1:q1].isspace():
+            return None
+        q2 = line.index('"', q1 + 1)
+        request = line[q1 + 1:q2]
+        # single-space separators only: then the split(' ') tokens agree
+        # with what the regex's \S+/\s+/.*? pieces would extract (a double
+        # space would e.g. leave a leading space on the path here)
+        tokens = request.split(' ')
+        if len(tokens) < 3 or request.split() != tokens:
+            return None
+        # the path is everything between the method and the protocol token
+        path = ' '.join(tokens[1:-1])
+        rest = line[q2 + 1:]
+        if not rest[:1].isspace():
+            return None
+        tail = rest.split(None, 2)
+        if len(tail) < 2 or not tail[0].isdecimal():
+            return None
+        matched = {
+            'ip': ip,
+            'userid': userid,
+            'date': date_tokens[0],
+            'timezone': date_tokens[1],
+            'method': tokens[0],
+            'path': path,
+            'status': tail[0],
+            'length': tail[1],
+        }
+        if self.has_host:
+            matched['host'] = host
+        if self.has_referrer:
+            q3 = line.index('"', q2 + 1)
+            # only the status and length tokens, surrounded by whitespace,
+            # may sit between the request and the referrer quotes
+            seg = line[q2 + 1:q3]
+            if seg.split() != tail[:2] or not seg[-1:].isspace():
+                return None
+            q4 = line.index('"', q3 + 1)
+            q5 = line.index('"', q4 + 1)
+            q6 = line.index('"', q5 + 1)
+            if not line[q4 + 1:q5].isspace():
+                return None
+            matched['referrer'] = line[q3 + 1:q4]
+            matched['user_agent'] = line[q5 + 1:q6]
+        return matched
+
+    def get(self, key):
+        try:
+            return self.matched[key]
+        except (KeyError, IndexError):
+            # IndexError covers lines served by the regex fallback, whose
+            # matched attribute is a match object rather than a dict
+            raise BaseFormatException("Cannot find group '%s'." % key)
+
+    def get_all(self,):
+        if isinstance(self.matched, dict):
+            return self.matched
+        return self.matched.groupdict()
+
+    def remove_ignored_groups(self, groups):
+        matched = self.get_all()
+        for group in groups:
+            del matched[group]
+        self.matched = matched
+
 _HOST_PREFIX = '(?P<host>[\w\-\.]*)(?::\d+)?\s+'
 
 _COMMON_LOG_FORMAT = (
@@ -487,6 +815,10 @@ class UrlHelper(object):
         structure that will convert correctly to JSON.
         """
 
+        # fast path: hits without PHP-array style keys need no conversion
+        if not any('[' in key for key in args):
+            return UrlHelper._convert_dicts_to_arrays(dict(args))
+
         final_args = {}
         for key, value in args.items():
             indices = key.split('[')
@@ -532,10 +864,8 @@ class UrlHelper(object):
 
     @staticmethod
     def _has_contiguous_int_keys(d):
-        for i in range(0, len(d)):
-            if str(i) not in d:
-                return False
-        return True
+        # one C-level set comparison instead of len(d) Python dict probes
+        return d.keys() == {str(i) for i in range(len(d))}
 
     @staticmethod
     def _convert_dict_to_array(d):
@@ -544,6 +874,24 @@ class UrlHelper(object):
             result.append(d[str(i)])
         return result
 
+    @staticmethod
+    def urlencode(args, _quote=urllib.parse.quote_from_bytes):
+        """
+        Minimal replacement for urllib.parse.urlencode: quotes key and value
+        straight through the C implemented quote_from_bytes and skips the
+        quoting entirely for int values, which never need it. Spaces become
+        %20 instead of +, which PHP decodes identically.
+        """
+        pairs = args.items() if isinstance(args, dict) else args
+        parts = []
+        for key, value in pairs:
+            if isinstance(value, int):
+                parts.append(_quote(key.encode('utf-8'), b'') + '=' + str(value))
+            else:
+                parts.append(_quote(key.encode('utf-8'), b'') + '='
+                             + _quote(str(value).encode('utf-8'), b''))
+        return '&'.join(parts)
+
 
 class Matomo(object):
     """
@@ -551,6 +899,28 @@ class Matomo(object):
     """
     def __init__(self):
         self.url = config.matomo_url
+        # one pool shared by all recorder threads, sized so each thread can
+        # keep its own connection alive across bulk requests; the thread
+        # count is the same expression main() uses to launch them
+        self._pool = None
+        if urllib3 is not None:
+            self._pool = urllib3.PoolManager(
+                maxsize=(config.options.get("concurrent_requests")
+                         or config.options.get("recorders") or 1),
+                block=False)
+        # fallback opener for installations without urllib3, built once: the
+        # handler stack never changes between requests. urllib itself still
+        # opens a fresh connection per request - only the pooled backend
+        # above gets real keep-alive - but the per-call opener construction
+        # is gone either way.
+        self._opener = urllib.request.build_opener(
+            Matomo.RedirectHandlerWithLogging(),
+            urllib.request.HTTPSHandler())
+        self._timeout = config.options.get("default_socket_timeout", None)
+        # opt-in: PHP does not transparently decompress request bodies, so
+        # only send gzip when the operator has confirmed the endpoint
+        # handles it (e.g. Matomo behind a decompressing proxy).
+        self._compress = bool(config.options.get("compress_tracking_requests"))
         self._send_request = self._real_request
         #check if we should really send
         if config.dry_run:
@@ -575,17 +945,29 @@ class Matomo(object):
             return urllib.request.HTTPRedirectHandler.redirect_request(self, req, fp, code, msg, hdrs, newurl)
 
     def _fake_request(self, request, data):
-        logging.info(f"Would send {request.get_method()} - {request.full_url} with {len(request.data)} bytes with {len(json.loads(data).get('requests', []))} requests. Timeout {config.options.get('default_socket_timeout', 'None')}")
+        if data[:2] == b'\x1f\x8b':
+            data = gzip.decompress(data)
+        logging.info(f"Would send {request.get_method()} - {request.full_url} with {len(request.data)} bytes with {len(_json_loads(data).get('requests', []))} requests. Timeout {config.options.get('default_socket_timeout', 'None')}")
         return b"{}"
 
     def _real_request(self, request, data):
-        # Use non-default SSL context if invalid certificates shall be
-        # accepted.
-        https_handler_args = {}
-        opener = urllib.request.build_opener(
-            Matomo.RedirectHandlerWithLogging(),
-            urllib.request.HTTPSHandler(**https_handler_args))
-        response = opener.open(request, timeout = config.options.get("default_socket_timeout", None))
+        if self._pool is not None:
+            # retries=False: let _call_wrapper own the retry policy instead of
+            # urllib3 masking failures with its internal retry/redirect logic.
+            response = self._pool.urlopen(
+                request.get_method(), request.full_url,
+                body=request.data,
+                headers=dict(request.header_items()),
+                timeout=self._timeout,
+                retries=False)
+            if response.status >= 400:
+                # mirror the stdlib opener, which raises on HTTP errors; the
+                # body is kept readable for _call_wrapper's diagnostics.
+                raise urllib.error.HTTPError(
+                    request.full_url, response.status, response.reason,
+                    response.headers, io.BytesIO(response.data))
+            return response.data
+        response = self._opener.open(request, timeout = self._timeout)
         result = response.read()
         response.close()
         return result
@@ -601,11 +983,16 @@ class Matomo(object):
         if data is None:
             # If Content-Type isn't defined, PHP do not parse the request's body.
             headers['Content-type'] = 'application/x-www-form-urlencoded'
-            data = urllib.parse.urlencode(args)
+            data = UrlHelper.urlencode(args)
         elif not isinstance(data, str) and headers['Content-type'] == 'application/json':
-            data = json.dumps(data).encode('utf-8')
+            data = _json_dumps(data)
+            if self._compress and len(data) > 1024:
+                # JSON bulk payloads compress several-fold; level 1 is cheap
+                # enough that even local installs come out ahead.
+                data = gzip.compress(data, compresslevel=1)
+                headers['Content-Encoding'] = 'gzip'
             if args:
-                path = path + '?' + urllib.parse.urlencode(args)
+                path = path + '?' + UrlHelper.urlencode(args)
 
         headers['User-Agent'] = 'Matomo/LogImport'
 
@@ -645,7 +1032,7 @@ class Matomo(object):
         res = self._call('/', final_args)
 
         try:
-            return json.loads(res.decode('utf-8'))
+            return _json_loads(res)
         except ValueError:
             raise urllib.error.URLError('Matomo returned an invalid response: ' + res)
 
@@ -653,6 +1040,14 @@ class Matomo(object):
         """
         Try to make requests to Matomo at most MATOMO_FAILURE_MAX_RETRY times.
         """
+        # look the retry options up once instead of on every failed attempt
+        try:
+            delay_after_failure = config.options["delay_after_failure"]
+            max_attempts = config.options["default_max_attempts"]
+        except NameError:
+            delay_after_failure = MATOMO_DEFAULT_DELAY_AFTER_FAILURE
+            max_attempts = MATOMO_DEFAULT_MAX_ATTEMPTS
+
         errors = 0
         while True:
             try:
@@ -665,7 +1060,7 @@ class Matomo(object):
 
                     raise urllib.error.URLError(error_message)
                 return response
-            except (urllib.error.URLError, http.client.HTTPException, ValueError, socket.timeout) as e:
+            except _RETRYABLE_ERRORS as e:
                 logging.warning('Error when connecting to Matomo: %s', e)
 
                 code = None
@@ -682,13 +1077,6 @@ class Matomo(object):
                 if hasattr(e, 'read'):
                     message = message + ", response: " + str(e.read())
 
-                try:
-                    delay_after_failure = config.options["delay_after_failure"]
-                    max_attempts = config.options["default_max_attempts"]
-                except NameError:
-                    delay_after_failure = MATOMO_DEFAULT_DELAY_AFTER_FAILURE
-                    max_attempts = MATOMO_DEFAULT_MAX_ATTEMPTS
-
                 errors += 1
                 if errors < max_attempts:
                     logging.error("Retrying request, attempt number %d" % (errors + 1))
@@ -704,6 +1092,18 @@ class Matomo(object):
     def call_api(self, method, **kwargs):
         return self._call_wrapper(self._call_api, None, None, method, **kwargs)
 
+@functools.lru_cache(maxsize=4096)
+def _cvar_dumps(items):
+    '''
+    JSON-encode a custom-variable dict, passed as a hashable tuple of
+    (index, (key, value)) pairs. Hits from the same repository share a
+    handful of shapes (typically one oaipmhID per record), so the encoded
+    strings repeat constantly within a batch and are memoized. Indices are
+    stringified here because orjson, unlike the stdlib encoder, refuses
+    non-string keys.
+    '''
+    return _json_dumps({str(index): list(pair) for index, pair in items}).decode('utf-8')
+
 class Recorder(object):
     """
     A Recorder fetches hits from the Queue and inserts them into Matomo using
@@ -711,12 +1111,33 @@ class Recorder(object):
     """
 
     recorders = []
-    queue = queue.Queue()
+    # Hits travel through a plain deque guarded by a condition variable and
+    # are handed over in batches: queue.Queue would take its mutex once per
+    # hit, the batched hand-off takes it once per _pending_limit hits. Each
+    # parser thread buffers into its own thread-local list, so no lock is
+    # taken until a batch is full.
+    queue = collections.deque()
+    queue_not_empty = threading.Condition()
+    pending = threading.local()
+    _pending_limit = 200
 
     def __init__(self):
         self.hits = []
         logging.debug(f"Max-Payload Size: {config.max_payload}")
         self.threshold = config.max_payload or 200
+        # snapshot the options used per hit: every config.options access goes
+        # through Configuration.__getattr__ plus a dict lookup
+        self._site_id = config.options["idSite"]
+        self._main_url = config.options["repository_base_url"]
+        self._token_auth = config.options["token_auth"]
+        # constant tracking parameters shared by every hit; _get_hit_args
+        # copies this instead of rebuilding the dict entry by entry
+        self._args_proto = {
+            'rec': '1',
+            'apiv': '1',
+            'idsite': self._site_id,
+            'bots': '1',
+        }
 
 
     @classmethod
@@ -724,6 +1145,7 @@ class Recorder(object):
         """
         Launch a bunch of Recorder objects in a separate thread.
         """
+        cls._pending_limit = config.max_payload or 200
         for i in range(recorder_count):
             recorder = Recorder()
             recorder.nbr = i
@@ -735,17 +1157,43 @@ class Recorder(object):
             t.start()
             logging.debug(f'Launched recorder {i} with threshold {recorder.threshold}')
 
+    @classmethod
+    def _pending_buffer(cls):
+        buffer = getattr(cls.pending, 'hits', None)
+        if buffer is None:
+            buffer = cls.pending.hits = []
+        return buffer
+
     @classmethod
     def add_hit(cls, hit):
-        cls.queue.put(hit)
+        buffer = cls._pending_buffer()
+        buffer.append(hit)
+        if len(buffer) >= cls._pending_limit:
+            cls.flush_pending()
 
     @classmethod
     def add_hits(cls, all_hits):
         """
         Add a set of hits to the recorders queue.
         """
-        for hit in all_hits:
-            cls.queue.put(hit)
+        buffer = cls._pending_buffer()
+        buffer.extend(all_hits)
+        if len(buffer) >= cls._pending_limit:
+            cls.flush_pending()
+
+    @classmethod
+    def flush_pending(cls):
+        """
+        Hand the calling thread's buffered hits over to the recorder threads
+        as one batch.
+        """
+        batch = getattr(cls.pending, 'hits', None)
+        if not batch:
+            return
+        cls.pending.hits = []
+        with cls.queue_not_empty:
+            cls.queue.append(batch)
+            cls.queue_not_empty.notify()
 
     @classmethod
     def wait_empty(cls):
@@ -754,27 +1202,37 @@ class Recorder(object):
         """
         #push none to signal final cleanup
         logging.debug("Waiting for recorders to end")
-        for i in cls.recorders:
-            cls.queue.put(None)
+        cls.flush_pending()
+        with cls.queue_not_empty:
+            for i in cls.recorders:
+                cls.queue.append(None)
+            cls.queue_not_empty.notify_all()
         #then end
-        while not cls.queue.empty() and not state.is_stopped:
+        while cls.queue and not state.is_stopped:
             sleep(0.5)
 
     def _run_bulk(self):
         while True:
+            with Recorder.queue_not_empty:
+                while not Recorder.queue:
+                    Recorder.queue_not_empty.wait()
+                batch = Recorder.queue.popleft()
             try:
-                hit = Recorder.queue.get()
-                if hit is None:
+                if batch is None:
                     logging.debug(f"Terminate recorder {self.nbr}")
                     #this recorder should terminate now
                     #process remaining hits
                     self._record_hits()
                     break
                 else:
-                    self.hits.append(hit)
-                    if len(self.hits) >= self.threshold:
+                    self.hits.extend(batch)
+                    while len(self.hits) >= self.threshold:
                         logging.debug("Trigger transport")
+                        # keep each tracking request at the payload threshold
+                        overflow = self.hits[self.threshold:]
+                        del self.hits[self.threshold:]
                         self._record_hits()
+                        self.hits.extend(overflow)
 
             except Matomo.Error as e:
                 logging.critical(f"Error {e}")
@@ -789,24 +1247,22 @@ class Recorder(object):
                 # TODO: we should log something here, however when this happens, logging.etc will throw
                 state.stop()
                 break
-            finally:
-                #always end the loop
-                #this includes the break statement in `if hit is None:` case
-                Recorder.queue.task_done()
         logging.debug(f"Recorder {self.nbr} finished")
 
     def date_to_matomo(self, date):
-        date, time = date.isoformat(sep=' ').split()
-        return '%s %s' % (date, time.replace('-', ':'))
+        # format the datetime fields directly instead of round-tripping
+        # through isoformat + split (whose '-' to ':' substitution was a
+        # no-op anyway: isoformat never puts a '-' in the time part)
+        return '%04d-%02d-%02d %02d:%02d:%02d' % (
+            date.year, date.month, date.day, date.hour, date.minute, date.second)
 
     def _get_hit_args(self, hit):
         """
         Returns the args used in tracking a hit, without the token_auth.
         """
         #site_id, main_url = resolver.resolve(hit)
-        site_id = config.options["idSite"]
         #repositoy base url
-        main_url = config.options["repository_base_url"]
+        main_url = self._main_url
 
         #stats.dates_recorded.add(hit.date.date())
 
@@ -816,19 +1272,16 @@ class Recorder(object):
         url_prefix = self._get_host_with_protocol(hit.host, main_url) if hasattr(hit, 'host') else main_url
         url = (url_prefix if path.startswith('/') else '') + path[:1024]
 
-        if (hit.referrer.find("?") >=0):
-            hit.referrer = hit.referrer.split("?")[0]+" "
+        referrer, sep, _ = hit.referrer.partition("?")
+        if sep:
+            hit.referrer = referrer + " "
 
-        args = {
-            'rec': '1',
-            'apiv': '1',
-            'url': url,
-            'urlref': hit.referrer[:1024],
-            'cip': hit.ip,
-            'cdt': self.date_to_matomo(hit.date),
-            'idsite': site_id,
-            'ua': hit.user_agent
-        }
+        args = self._args_proto.copy()
+        args['url'] = url
+        args['urlref'] = hit.referrer[:1024]
+        args['cip'] = hit.ip
+        args['cdt'] = self.date_to_matomo(hit.date)
+        args['ua'] = hit.user_agent
 
         # idsite is already determined by resolver
         if 'idsite' in hit.args:
@@ -836,11 +1289,9 @@ class Recorder(object):
             
         args.update(hit.args)
 
-        if hit.is_download:
+        if hit.flags & F_DOWNLOAD:
             args['download'] = args['url']
 
-        args['bots'] = '1'
-
         if hit.generation_time_milli > 0:
             args['gt_ms'] = int(hit.generation_time_milli)
 
@@ -856,10 +1307,12 @@ class Recorder(object):
 
         # convert custom variable args to JSON
         if 'cvar' in args and not isinstance(args['cvar'], str):
-            args['cvar'] = json.dumps(args['cvar'])
+            args['cvar'] = _cvar_dumps(tuple(
+                (index, tuple(pair)) for index, pair in args['cvar'].items()))
 
         if '_cvar' in args and not isinstance(args['_cvar'], str):
-            args['_cvar'] = json.dumps(args['_cvar'])
+            args['_cvar'] = _cvar_dumps(tuple(
+                (index, tuple(pair)) for index, pair in args['_cvar'].items()))
 
         return UrlHelper.convert_array_args(args)
 
@@ -879,7 +1332,7 @@ class Recorder(object):
             return
         
         data = {
-            'token_auth': config.options["token_auth"],
+            'token_auth': self._token_auth,
             'requests': [self._get_hit_args(hit) for hit in self.hits]
         }
 
@@ -895,7 +1348,7 @@ class Recorder(object):
             )
             # check for invalid requests
             try:
-                response = json.loads(response.decode('utf-8'))
+                response = _json_loads(response)
             except:
                 logging.info("bulk tracking returned invalid JSON")
 
@@ -931,7 +1384,7 @@ class Recorder(object):
         they are not logged twice.
         """
         try:
-            response = json.loads(response.decode('utf-8'))
+            response = _json_loads(response)
         except:
             # the response should be in JSON, but in case it can't be parsed just try another attempt
             logging.debug("cannot parse tracker response, should be valid JSON")
@@ -943,14 +1396,35 @@ class Recorder(object):
 
         return response['message']
 
+# Hit classification flags, packed into Hit.flags so routing reads a single
+# int instead of several boolean attributes.
+F_META = 1
+F_DOWNLOAD = 2
+F_ROBOT = 4
+F_ERROR = 8
+F_REDIRECT = 16
+
 class Hit(object):
     """
-    It's a simple container.
+    It's a simple container. __slots__ keeps the per-line instances small
+    and makes attribute access an array-offset read instead of a dict
+    lookup; host is assigned only for formats that carry one, so the
+    hasattr checks elsewhere keep working.
     """
-    def __init__(self, **kwargs):
-        for key, value in kwargs.items():
-            setattr(self, key, value)
-        super(Hit, self).__init__()
+    __slots__ = (
+        'filename', 'lineno', 'status', 'path', 'referrer', 'user_agent',
+        'ip', 'length', 'generation_time_milli', 'host', 'userid',
+        'event_category', 'event_action', 'event_name', 'date', 'args',
+        'flags',
+    )
+
+    def __init__(self, filename, lineno, status, path):
+        self.filename = filename
+        self.lineno = lineno
+        self.status = status
+        self.path = path
+        self.args = {}
+        self.flags = 0
 
 
     def get_visitor_id_hash(self):
@@ -1000,9 +1474,131 @@ class CheckRobots(object):
         self._readCOUNTERRobots()
 
 
-MONTHS = {'Jan': 1, 'Feb': 2, 'Mar': 3, 'Apr': 4,
-          'May': 5, 'Jun': 6, 'Jul': 7, 'Aug': 8,
-          'Sep': 9, 'Oct': 10, 'Nov': 11, 'Dec': 12}    
+def _literal_prefix(pattern):
+    '''
+    Return the literal prefix every match of the anchored `pattern` must
+    start with, stopping at the first regex construct ('' if the pattern
+    opens with one). A character followed by a quantifier is excluded, since
+    it is not mandatory, and a pattern with a top-level alternation has no
+    mandatory prefix at all: only one branch needs to start with it.
+
+    >>> _literal_prefix('/bitstream|/retrieve')
+    ''
+    >>> _literal_prefix('/(bitstream|retrieve)/x')
+    '/'
+    >>> _literal_prefix('/statistics')
+    '/statistics'
+    '''
+    if pattern.startswith('^'):
+        pattern = pattern[1:]
+    # scan for a '|' outside any group or character class first: with one
+    # present, no prefix is mandatory. Misreading an exotic class like []|]
+    # errs towards '' here, which only costs the prefilter shortcut.
+    depth = 0
+    in_class = False
+    i = 0
+    n = len(pattern)
+    while i < n:
+        c = pattern[i]
+        if c == '\\':
+            i += 2
+            continue
+        if in_class:
+            if c == ']':
+                in_class = False
+        elif c == '[':
+            in_class = True
+        elif c == '(':
+            depth += 1
+        elif c == ')':
+            depth -= 1
+        elif c == '|' and depth == 0:
+            return ''
+        i += 1
+    prefix = []
+    i = 0
+    n = len(pattern)
+    while i < n:
+        c = pattern[i]
+        if c == '\\' and i + 1 < n and not pattern[i + 1].isalnum():
+            c = pattern[i + 1]
+            i += 2
+        elif c in '.^$*+?{}[]\\|()':
+            break
+        else:
+            i += 1
+        if i < n and pattern[i] in '*+?{':
+            break
+        prefix.append(c)
+    return ''.join(prefix)
+
+@functools.lru_cache(maxsize=1 << 16)
+def _anonymize_ip(ip):
+    '''
+    Mask the last two IPv4 octets. The address is parsed and formatted by the
+    C socket routines, and since the same clients appear on many lines the
+    result is memoized per address. IPv6 and unparsable addresses pass
+    through untouched.
+    '''
+    if ':' in ip:
+        return ip
+    try:
+        packed = struct.unpack('!I', socket.inet_aton(ip))[0] & 0xFFFF0000
+    except OSError:
+        return ip
+    return socket.inet_ntoa(struct.pack('!I', packed))
+
+class _ReplayableStream(object):
+    '''
+    Wrap a non-seekable text stream (stdin, gzip, bz2) so the lines consumed
+    by format detection can be read again. seek(0) rewinds to the first
+    recorded line instead of restarting the decompressor (or, for stdin,
+    silently losing the probed lines); once the recorded lines are drained
+    the buffer is dropped and reads go straight through.
+    '''
+
+    def __init__(self, stream):
+        self._stream = stream
+        self._recorded = []
+        self._pos = 0
+
+    def readline(self):
+        if self._pos < len(self._recorded):
+            line = self._recorded[self._pos]
+            self._pos += 1
+            return line
+        line = self._stream.readline()
+        if line:
+            self._recorded.append(line)
+            self._pos = len(self._recorded)
+        return line
+
+    def seek(self, offset):
+        if offset != 0:
+            raise IOError('can only rewind to the start of the stream')
+        self._pos = 0
+
+    def readlines(self, hint=-1):
+        # the parse loop never rewinds, so the replay buffer is handed out
+        # as the first batch and then released
+        if self._pos < len(self._recorded):
+            lines = self._recorded[self._pos:]
+            self._recorded = []
+            self._pos = 0
+            return lines
+        self._recorded = []
+        self._pos = 0
+        return self._stream.readlines(hint)
+
+    def read(self, size=-1):
+        if self._pos < len(self._recorded):
+            data = ''.join(self._recorded[self._pos:])
+            self._recorded = []
+            self._pos = 0
+            return data
+        self._recorded = []
+        self._pos = 0
+        return self._stream.read(size)
 
 class Parser(object):
     """
@@ -1010,10 +1606,22 @@ class Parser(object):
     a Queue.
     """
 
+    # cache marker for timezone strings that failed to parse
+    INVALID_TIMEZONE = object()
+
+    # Detection probes the shared registry instances, and W3C-style formats
+    # rebuild their regex in place from each file's Fields header while being
+    # probed. One file at a time may do that; parsing only starts once the
+    # per-file copy below has been taken under this lock.
+    _detect_lock = threading.Lock()
+
     def __init__(self):
-        self.check_methods = [method for name, method
-                              in inspect.getmembers(self, predicate=inspect.ismethod)
-                              if name.startswith('check_')]
+        # detected formats, keyed by digit-collapsed basename (see parse)
+        self._format_cache = {}
+        # parsed timezone offsets, keyed by their raw string: a log rarely
+        # carries more than a handful of distinct offsets, so each timedelta
+        # is constructed once instead of once per line
+        self._tz_cache = {}
         self.gen_matcher()
 
     def gen_matcher(self):
@@ -1029,52 +1637,134 @@ class Parser(object):
                 for i in config.options["tracking_download"]:
                     pattern = re.compile(i)
                     self.tracking_download.append(pattern)
+        self._metadata_prefilter = self._build_path_prefilter(self.tracking_metadata)
+        self._download_prefilter = self._build_path_prefilter(self.tracking_download)
         #user_agents
+        # one alternation over all COUNTER robot patterns: a single re.search
+        # scans each user agent once instead of dispatching into the regex
+        # engine once per pattern
         self.user_agents = []
         for p in checkRobots.counterRobotsList:
             self.user_agents.append(re.compile(p["pattern"]))
+        self.user_agents_re = None
+        if self.user_agents:
+            try:
+                self.user_agents_re = re.compile(
+                    "|".join("(?:%s)" % p["pattern"] for p in checkRobots.counterRobotsList))
+            except re.error:
+                logging.debug("Cannot combine robot patterns, matching them one by one")
+        # with hyperscan available, all robot patterns compile into one
+        # multi-pattern database scanned in a single pass per user agent
+        self.user_agents_db = None
+        if hyperscan is not None and self.user_agents:
+            patterns = [p["pattern"].encode('utf-8') for p in checkRobots.counterRobotsList]
+            try:
+                db = hyperscan.Database()
+                db.compile(expressions=patterns,
+                           ids=list(range(len(patterns))),
+                           flags=[hyperscan.HS_FLAG_SINGLEMATCH] * len(patterns))
+                self.user_agents_db = db
+            except Exception:
+                logging.debug("Cannot compile robot patterns for hyperscan, using re")
+
 
+    @staticmethod
+    def _build_path_prefilter(compiled):
+        '''
+        Build an Aho-Corasick automaton over the mandatory literal prefixes
+        of the given path regexes. Returns (automaton, fallback) where
+        fallback holds the regexes without a usable prefix, or None when
+        pyahocorasick is missing or nothing can be prefiltered.
+        '''
+        if ahocorasick is None or not compiled:
+            return None
+        literal_map = {}
+        fallback = []
+        for index, regex in enumerate(compiled):
+            prefix = _literal_prefix(regex.pattern)
+            if len(prefix) >= 3:
+                literal_map.setdefault(prefix, []).append(index)
+            else:
+                fallback.append(regex)
+        if not literal_map:
+            return None
+        automaton = ahocorasick.Automaton()
+        for prefix, indexes in literal_map.items():
+            automaton.add_word(prefix, (len(prefix), indexes))
+        automaton.make_automaton()
+        return automaton, fallback
+
+    def _candidate_path_regexes(self, compiled, prefilter, path):
+        '''
+        The subset of `compiled` that may match `path`: one automaton pass
+        selects the patterns whose literal prefix sits at the start of the
+        path (the patterns are matched anchored), plus the fallback patterns
+        that always run.
+        '''
+        if prefilter is None:
+            return compiled
+        automaton, fallback = prefilter
+        candidates = list(fallback)
+        for end_index, (length, indexes) in automaton.iter(path):
+            if end_index == length - 1:
+                candidates.extend(compiled[i] for i in indexes)
+        return candidates
 
     ## All check_* methods are called for each hit and must return True if the
     ## hit can be imported, False otherwise.
 
     def check_static(self, hit):
-        for regEx in self.tracking_metadata:
+        for regEx in self._candidate_path_regexes(self.tracking_metadata, self._metadata_prefilter, hit.path):
             oai = regEx.match(hit.path)
             if not oai is None:
                 finalOAIpmh=config.options["oaipmh_preamble"]+oai.group(1)[oai.group(1).rfind("/")+1:]
                 if finalOAIpmh!=config.options["oaipmh_preamble"]:
                     hit.add_page_custom_var("oaipmhID",finalOAIpmh)
-                    hit.is_meta=True
+                    hit.flags |= F_META
         return True
 
     def check_download(self, hit):
-        for regEx in self.tracking_download:
+        for regEx in self._candidate_path_regexes(self.tracking_download, self._download_prefilter, hit.path):
             oai = regEx.match(hit.path)
             if not oai is None:
                 finalOAIpmh=config.options["oaipmh_preamble"]+oai.group(1)[oai.group(1).rfind("/")+1:]
                 if finalOAIpmh!=config.options["oaipmh_preamble"]:
                     hit.add_page_custom_var("oaipmhID",finalOAIpmh)
-                    hit.is_download = True
+                    hit.flags |= F_DOWNLOAD
                     break
         return True
 
-    def check_user_agent(self, hit):
+    def _is_robot(self, user_agent):
+        '''
+        Whether the user agent matches the COUNTER robot list. Not a check_*
+        method: parse runs it before any further field extraction so robot
+        lines pay as little as possible.
+        '''
+        if self.user_agents_db is not None:
+            matched = []
+            def on_match(id, from_, to, flags, context):
+                matched.append(id)
+            self.user_agents_db.scan(user_agent.encode('utf-8', 'replace'),
+                                     match_event_handler=on_match)
+            return bool(matched)
+        if self.user_agents_re is not None:
+            return self.user_agents_re.search(user_agent) is not None
         for robot in self.user_agents:
-            if robot.search(hit.user_agent):
-                stats.count_lines_skipped_user_agent.increment()
-                hit.is_robot = True
-                break
-        return True
+            if robot.search(user_agent):
+                return True
+        return False
 
     def check_http_error(self, hit):
-        if 4 <= int(hit.status[0]) <= 5:
-            hit.is_error = True
+        # compare the leading character directly instead of paying an int()
+        # per line; slicing instead of indexing also tolerates empty statuses
+        first = hit.status[:1]
+        if first == '4' or first == '5':
+            hit.flags |= F_ERROR
         return True
 
     def check_http_redirect(self, hit):
-        if hit.status[0] == '3' and hit.status != '304':
-             hit.is_redirect = True
+        if hit.status[:1] == '3' and hit.status != '304':
+            hit.flags |= F_REDIRECT
         return True
 
     @staticmethod
@@ -1159,18 +1849,67 @@ class Parser(object):
             return
 
         logging.debug('Format %s is the best match', format.name)
+
+        # the fixed-layout Apache formats get a regex-free scanner
+        if format.name in FastApacheFormat.LAYOUTS:
+            logging.debug('Using fast scanner for format %s', format.name)
+            format = FastApacheFormat(format)
         return format
 
-    def is_filtered(self, hit):
-        host = None
-        if hasattr(hit, 'host'):
-            host = hit.host
-        else:
+    @staticmethod
+    def _line_batches(file, use_mmap, batch_size=1024 * 1024):
+        '''
+        Yield the file's lines in ~1 MiB batches. Plain files are memory
+        mapped so every byte is read straight from the page cache and touched
+        once; streams (stdin, gzip, bz2) read a chunk at a time and split it
+        once, carrying a partial trailing line into the next chunk. Either
+        way the newline scanning and decoding run in C once per batch instead
+        of once per line.
+        '''
+        def split_keepends(text):
+            # split on '\n' only, keeping it, exactly like readline() did:
+            # splitlines() would also break on U+2028/U+2029, NEL and other
+            # verticals that can legitimately sit inside a logged field
+            parts = text.split('\n')
+            tail = parts.pop()
+            lines = [part + '\n' for part in parts]
+            return lines, tail
+
+        if use_mmap:
             try:
-                host = urllib.parse.urlparse(hit.path).hostname
-            except:
-                pass
-        return (False, None)
+                mm = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            except (ValueError, OSError):
+                # empty files (and exotic filesystems) cannot be mapped
+                mm = None
+            if mm is not None:
+                with mm:
+                    start = 0
+                    size = len(mm)
+                    while start < size:
+                        # cut each batch at the next newline
+                        end = min(start + batch_size, size)
+                        nl = mm.find(b'\n', end)
+                        end = size if nl == -1 else nl + 1
+                        lines, last = split_keepends(
+                            mm[start:end].decode('utf-8', 'replace'))
+                        if last:
+                            # only possible at eof: batches end on a newline
+                            lines.append(last)
+                        yield lines
+                        start = end
+                return
+        tail = ''
+        while True:
+            chunk = file.read(batch_size)
+            if not chunk:
+                break
+            if tail:
+                chunk = tail + chunk
+            lines, tail = split_keepends(chunk)
+            if lines:
+                yield lines
+        if tail:
+            yield [tail]
 
     def parse(self, filename):
         """
@@ -1179,12 +1918,10 @@ class Parser(object):
         def invalid_line(line, reason):
             logging.debug('Invalid line detected (%s): %s' % (reason, line))
 
-        def filtered_line(line, reason):
-            logging.debug('Filtered line out (%s): %s' % (reason, line))
-
+        use_mmap = False
         if filename == '-':
             filename = '(stdin)'
-            file = sys.stdin
+            file = _ReplayableStream(sys.stdin)
         else:
             if not os.path.exists(filename):
                 logging.warning(f"=====> File {file} does not exist <=====")
@@ -1196,176 +1933,247 @@ class Parser(object):
                     open_func = gzip.open
                 else:
                     open_func = open
-                import io
-                file = io.TextIOWrapper(open_func(filename, 'rb'))
-
-
-        format = self.detect_format(file)
-        if format is None:
-            return logging.critical(
-                'Cannot guess the logs format. Please give one using '
-                'either the --log-format-name or --log-format-regex option'
-            )
+                    use_mmap = True
+                # a 256 KiB buffer between the (de)compressor and the text
+                # layer keeps reads in the throughput sweet spot and amortizes
+                # the syscall/decompression call per readlines() batch
+                file = io.TextIOWrapper(io.BufferedReader(open_func(filename, 'rb'), buffer_size=256 * 1024))
+                if not use_mmap:
+                    # let format detection rewind without the decompressor
+                    # re-inflating everything it already produced
+                    file = _ReplayableStream(file)
+
+
+        # Sibling log files (rotations of the same log) share their format, so
+        # cache the detection result per digit-collapsed basename and only pay
+        # the full probe for the first file of a series. W3C-style formats are
+        # excluded: their regex is rebuilt from each file's Fields header.
+        with Parser._detect_lock:
+            format = None
+            cache_key = None
+            if filename != '(stdin)':
+                cache_key = re.sub(r'\d+', '#', os.path.basename(filename))
+                cached = self._format_cache.get(cache_key)
+                if cached is not None and cached.check_format(file):
+                    logging.debug('Reusing cached format %s for %s', cached.name, filename)
+                    format = cached
+            if format is None:
+                format = self.detect_format(file)
+                if (format is not None and cache_key is not None
+                        and not isinstance(format, W3cExtendedFormat)):
+                    self._format_cache[cache_key] = format
+            if format is None:
+                return logging.critical(
+                    'Cannot guess the logs format. Please give one using '
+                    'either the --log-format-name or --log-format-regex option'
+                )
+            # Formats from the registry carry per-line match state, so each
+            # file works on its own shallow copy, taken before the lock is
+            # released so the next file's detection cannot mutate W3C-style
+            # state this file still depends on.
+            format = copy.copy(format)
+            if isinstance(format, FastApacheFormat):
+                format.fallback = copy.copy(format.fallback)
         # Make sure the format is compatible with the resolver.
         #resolver.check_format(format)
         valid_lines_count = 0
 
-        hits = []
-        lineno = -1
-        while not state.is_stopped:
-            line = file.readline()
+        # The per-line loop is the nearest thing this importer has to a JIT
+        # target; with no compiled-extension build to lean on, the method
+        # lookups it would otherwise repeat on every line are bound once per
+        # file instead.
+        format_match = format.match
+        get = format.get
+        parse_time = format.parseTime
+        # whether a field can arrive with enclosing quotes is a property of
+        # the format's pattern, so resolve it once per file rather than
+        # testing every line
+        dequote_user_agent = format.may_emit_quotes('user_agent')
+        dequote_referrer = format.may_emit_quotes('referrer')
+        dequote_host = format.may_emit_quotes('host')
+        # per-line reads of config and stats go through __getattr__ plus a
+        # dict lookup each time; snapshot them once per file as well
+        ip_anonymization = config.options["ip_anonymization"]
+        skip = config.skip
+        count_lines_parsed = stats.count_lines_parsed
+        count_skipped_user_agent = stats.count_lines_skipped_user_agent.increment
+        count_static = stats.count_lines_static.increment
+        count_downloads = stats.count_lines_downloads.increment
+        add_hit = Recorder.add_hit
+        tz_cache = self._tz_cache
+        invalid_timezone = Parser.INVALID_TIMEZONE
+        check_static = self.check_static
+        check_download = self.check_download
+        check_http_error = self.check_http_error
+        check_http_redirect = self.check_http_redirect
 
-            if not line: break
-            lineno = lineno + 1
-
-
-            stats.count_lines_parsed.increment()
-            if stats.count_lines_parsed.value <= config.skip:
-                continue
+        lineno = -1
+        last_date_string = None
+        last_date = None
+        for lines in self._line_batches(file, use_mmap):
+            if state.is_stopped:
+                break
+            for line in lines:
+                lineno = lineno + 1
 
-            match = format.match(line)
-            if not match:
-                invalid_line(line, 'line did not match')
-                continue
+                count_lines_parsed.increment()
+                if count_lines_parsed.value <= skip:
+                    continue
 
-            valid_lines_count = valid_lines_count + 1
-            try:
-                format_status = format.get('status')
-            except:
-                format_status = ""
-            try:
-                format_path = format.get('path')
-            except:
-                format_path = ""
-
-            hit = Hit(
-                filename=filename,
-                lineno=lineno,
-                status=format_status,
-                full_path=format_path,
-                is_meta=False,
-                is_download=False,
-                is_robot=False,
-                is_error=False,
-                is_redirect=False,
-                args={},
-            )
+                match = format_match(line)
+                if not match:
+                    invalid_line(line, 'line did not match')
+                    continue
 
-            # W3cExtendedFormat detaults to - when there is no query string, but we want empty string
-            hit.query_string = ''
-            hit.path = hit.full_path
+                valid_lines_count = valid_lines_count + 1
+                try:
+                    format_status = get('status')
+                except:
+                    format_status = ""
+                try:
+                    format_path = get('path')
+                except:
+                    format_path = ""
 
-            try:
-                hit.referrer = format.get('referrer')
+                hit = Hit(filename, lineno, format_status, format_path)
 
-                if hit.referrer.startswith('"'):
-                    hit.referrer = hit.referrer[1:-1]
-            except BaseFormatException:
-                hit.referrer = ''
-            if hit.referrer == '-':
-                hit.referrer = ''
+                try:
+                    hit.user_agent = get('user_agent')
+
+                    # in case a format parser included enclosing quotes, remove them so they are not
+                    # sent to Matomo
+                    if dequote_user_agent and hit.user_agent.startswith('"'):
+                        hit.user_agent = hit.user_agent[1:-1]
+                except BaseFormatException:
+                    hit.user_agent = ''
+
+                # Robot traffic is a large share of raw logs and is never
+                # imported, so classify it before any further field
+                # extraction or date parsing is paid for.
+                if self._is_robot(hit.user_agent):
+                    count_skipped_user_agent()
+                    continue
 
-            try:
-                hit.user_agent = format.get('user_agent')
+                try:
+                    hit.referrer = get('referrer')
 
-                # in case a format parser included enclosing quotes, remove them so they are not
-                # sent to Matomo
-                if hit.user_agent.startswith('"'):
-                    hit.user_agent = hit.user_agent[1:-1]
-            except BaseFormatException:
-                hit.user_agent = ''
+                    if dequote_referrer and hit.referrer.startswith('"'):
+                        hit.referrer = hit.referrer[1:-1]
+                except BaseFormatException:
+                    hit.referrer = ''
+                if hit.referrer == '-':
+                    hit.referrer = ''
 
-            hit.ip = format.get('ip')
+                hit.ip = get('ip')
 
-            #IP anonymization
-            if config.options["ip_anonymization"]:
-                ip0, ip1, *_ = hit.ip.split('.')
-                hit.ip = f"{ip0}.{ip1}.0.0"
+                #IP anonymization
+                if ip_anonymization:
+                    hit.ip = _anonymize_ip(hit.ip)
 
-            try:
-                hit.length = int(format.get('length'))
-            except (ValueError, BaseFormatException):
-                # Some lines or formats don't have a length (e.g. 304 redirects, W3C logs)
-                hit.length = 0
+                try:
+                    hit.length = int(get('length'))
+                except (ValueError, BaseFormatException):
+                    # Some lines or formats don't have a length (e.g. 304 redirects, W3C logs)
+                    hit.length = 0
 
-            try:
-                hit.generation_time_milli = float(format.get('generation_time_milli'))
-            except (ValueError, BaseFormatException):
                 try:
-                    hit.generation_time_milli = float(format.get('generation_time_micro')) / 1000
+                    hit.generation_time_milli = float(get('generation_time_milli'))
                 except (ValueError, BaseFormatException):
                     try:
-                        hit.generation_time_milli = float(format.get('generation_time_secs')) * 1000
+                        hit.generation_time_milli = float(get('generation_time_micro')) / 1000
                     except (ValueError, BaseFormatException):
-                        hit.generation_time_milli = 0
-
-            try:
-                hit.host = format.get('host').lower().strip('.')
-                if hit.host.startswith('"'):
-                    hit.host = hit.host[1:-1]
-            except BaseFormatException:
-                # Some formats have no host.
-                pass
-
-            # Add userid
-            try:
-                hit.userid = None
-                userid = format.get('userid')
-                if userid != '-':
-                    hit.args['uid'] = hit.userid = userid
-            except:
-                pass
-
-            # add event info
-            try:
-                hit.event_category = hit.event_action = hit.event_name = None
-
-                hit.event_category = format.get('event_category')
-                hit.event_action = format.get('event_action')
+                        try:
+                            hit.generation_time_milli = float(get('generation_time_secs')) * 1000
+                        except (ValueError, BaseFormatException):
+                            hit.generation_time_milli = 0
 
-                hit.event_name = format.get('event_name')
-                if hit.event_name == '-':
-                    hit.event_name = None
-            except:
-                pass
-
-            # Check if the hit must be excluded.
-            if not all((method(hit) for method in self.check_methods)):
-                continue
-
-            # Parse date.
-            # We parse it after calling check_methods as it's quite CPU hungry, and
-            # we want to avoid that cost for excluded hits.
-            date_string = format.get('date')
-
-            try:
-                hit.date = format.parseTime(date_string)
-            except ValueError as e:
-                invalid_line(line, 'invalid date or invalid format: %s' % str(e))
-                continue
-
-            # Parse timezone and substract its value from the date
-            try:
-                timezone = float(format.get('timezone'))
-            except BaseFormatException:
-                timezone = 0
-            except ValueError:
-                invalid_line(line, 'invalid timezone')
-                continue
-
-            if timezone:
-                hit.date -= datetime.timedelta(hours=timezone/100)
-
-            (is_filtered, reason) = self.is_filtered(hit)
-            if is_filtered:
-                filtered_line(line, reason)
-                continue
-            if (not hit.is_robot) and (hit.is_meta or hit.is_download) and (not hit.is_redirect):
-                Recorder.add_hit(hit)
-            if (not hit.is_robot and not hit.is_redirect and hit.is_meta):
-                stats.count_lines_static.increment()
-            if (not hit.is_robot and not hit.is_redirect and hit.is_download):
-                stats.count_lines_downloads.increment()
+                try:
+                    hit.host = get('host').lower().strip('.')
+                    if dequote_host and hit.host.startswith('"'):
+                        hit.host = hit.host[1:-1]
+                except BaseFormatException:
+                    # Some formats have no host.
+                    pass
+
+                # Add userid
+                try:
+                    hit.userid = None
+                    userid = get('userid')
+                    if userid != '-':
+                        hit.args['uid'] = hit.userid = userid
+                except:
+                    pass
+
+                # add event info
+                try:
+                    hit.event_category = hit.event_action = hit.event_name = None
+
+                    hit.event_category = get('event_category')
+                    hit.event_action = get('event_action')
+
+                    hit.event_name = get('event_name')
+                    if hit.event_name == '-':
+                        hit.event_name = None
+                except:
+                    pass
+
+                # Classify the hit. All four checks always return True; they
+                # only set flags, so there is nothing to exclude here.
+                check_static(hit)
+                check_download(hit)
+                check_http_error(hit)
+                check_http_redirect(hit)
+
+                # Parse date.
+                # We parse it after the classification as it's quite CPU hungry, and
+                # we want to avoid that cost for excluded hits.
+                # Consecutive lines usually fall into the same second, so the
+                # last parsed timestamp is memoized.
+                date_string = get('date')
+                if date_string == last_date_string:
+                    hit.date = last_date
+                else:
+                    try:
+                        hit.date = parse_time(date_string)
+                    except ValueError as e:
+                        invalid_line(line, 'invalid date or invalid format: %s' % str(e))
+                        continue
+                    last_date_string = date_string
+                    last_date = hit.date
+
+                # Parse timezone and substract its value from the date
+                try:
+                    tz_string = get('timezone')
+                except BaseFormatException:
+                    tz_string = None
+
+                if tz_string is not None:
+                    delta = tz_cache.get(tz_string)
+                    if delta is None:
+                        try:
+                            delta = datetime.timedelta(hours=float(tz_string)/100)
+                        except ValueError:
+                            delta = invalid_timezone
+                        tz_cache[tz_string] = delta
+                    if delta is invalid_timezone:
+                        invalid_line(line, 'invalid timezone')
+                        continue
+                    if delta:
+                        hit.date -= delta
+
+                # robot lines were skipped right after user-agent
+                # extraction, so only meta/download/redirect matter here
+                f = hit.flags
+                if f & (F_META | F_DOWNLOAD) and not f & F_REDIRECT:
+                    add_hit(hit)
+                    if f & F_META:
+                        count_static()
+                    if f & F_DOWNLOAD:
+                        count_downloads()
+
+        # hand over whatever this thread still buffers, so the file is fully
+        # queued by the time parse() returns to its worker
+        Recorder.flush_pending()
 
 class Statistics(object):
     """
@@ -1375,21 +2183,24 @@ class Statistics(object):
 
     class Counter(object):
         """
-        Simple integers cannot be used by multithreaded programs. See:
-        http://stackoverflow.com/questions/6320107/are-python-ints-thread-safe
+        A counter with a deliberately asymmetric pair of update methods:
+        increment() is a bare int add - a single bytecode pair under the
+        GIL - because it runs once per log line and only feeds progress
+        reporting, where a lost update under a rare preemption is
+        acceptable. advance() takes a lock, because it is called once per
+        recorded bulk batch from several recorder threads and feeds the
+        final "requests imported successfully" total, which must be exact.
         """
         def __init__(self):
-            # itertools.count's implementation in C does not release the GIL and
-            # therefore is thread-safe.
-            self.counter = itertools.count(1)
             self.value = 0
+            self._lock = threading.Lock()
 
         def increment(self):
-            self.value = next(self.counter)
+            self.value += 1
 
         def advance(self, n):
-            for i in range(n):
-                self.increment()
+            with self._lock:
+                self.value += n
 
         def __str__(self):
             return str(int(self.value))
@@ -1519,14 +2330,16 @@ Performance summary
 
 class State:
     def __init__(self):
-        self._stopped = True
+        # an Event makes is_stopped a lock-free read: it is polled from the
+        # per-line loops, where taking a mutex per check adds up
+        self._stopped = threading.Event()
+        self._stopped.set()
         self._reason = None
         self._lock = threading.Lock()
 
     @property
     def is_stopped(self):
-        with self._lock:
-            return self._stopped
+        return self._stopped.is_set()
 
     @property
     def reason(self):
@@ -1534,14 +2347,13 @@ class State:
             return self._reason
 
     def start(self):
-        with self._lock:
-            self._stopped = False
+        self._stopped.clear()
 
     def stop(self, reason = None):
         with self._lock:
-            if self._stopped:
+            if self._stopped.is_set():
                 return
-            self._stopped = True
+            self._stopped.set()
             self._reason = reason
 
 def main():
@@ -1551,14 +2363,31 @@ def main():
     state.start()
     stats.set_time_start()
     stats.start_monitor()
-    Recorder.launch(config.options["recorders"])
+    # Each recorder thread keeps one bulk request in flight, so the thread
+    # count bounds how many requests overlap their network latency.
+    # "concurrent_requests" can raise that bound beyond the CPU-oriented
+    # "recorders" default for imports dominated by a high-RTT Matomo server.
+    recorder_count = config.options.get("concurrent_requests") or config.options["recorders"]
+    Recorder.launch(recorder_count)
+
+    def parse_file(filename):
+        if state.is_stopped:
+            return
+        logging.info(f"Reading {filename} ...")
+        parser.parse(filename)
 
     try:
-        for filename in config.filenames:
-            if state.is_stopped:
-                break
-            logging.info(f"Reading {filename} ...")
-            parser.parse(filename)
+        jobs = config.jobs or 1
+        if jobs > 1:
+            # gzip/bz2 inflation and disk reads release the GIL, so a small
+            # pool of parser threads overlaps decompression with parsing
+            # across a series of rotated logs
+            with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+                for future in [executor.submit(parse_file, f) for f in config.filenames]:
+                    future.result()
+        else:
+            for filename in config.filenames:
+                parse_file(filename)
 
         Recorder.wait_empty()
     except KeyboardInterrupt: